@@ -0,0 +1,522 @@
+"""
+    Library side of cr-codereview.py
+
+    Collects the modified, newly added and deleted files of a p4 workspace
+    and produces their differences in-process, so that callers (e.g. a review
+    bot) don't have to run cr-codereview.py and re-parse its text output.
+
+    Typical use:
+
+        import cr_codereview
+
+        for fdiff in cr_codereview.iter_diffs(myfiles=['...']):
+            print fdiff.depotfile, fdiff.change
+            print fdiff.hunks
+"""
+
+import sys
+import os
+import subprocess
+import re
+import tempfile
+
+
+P4DEFAULT_OPT = "-du"
+
+P4FILECHANGED_REGEX = re.compile(r'(.*?)#(\d+)\s*-\s*(\w+).*?\((\w+)\)')
+
+MODIFIED_STR = """\
+... depotFile %s
+... clientFile %s
+... rev %s
+... type %s
+
+"""
+
+ADDED_STR = """
+--- /dev/null
++++ %s\t(revision %s)
+"""
+
+DELETED_STR = """
+--- %s\t(revision %s)
++++ /dev/null
+"""
+
+# The output looks like this for each file of a "p4 diff2"
+# ==== //depot/rel1/foo.c#3 (text) - //depot/rel2/foo.c#5 (text) ==== content
+# ==== <none> - //depot/rel2/new.c#1 ====
+# ==== //depot/rel1/old.c#2 - <none> ====
+P4DIFF2_HEADER_REGEX = re.compile(
+    r'^==== (<none>|.+?#\d+(?: \(\S+\))?) - '
+    r'(<none>|.+?#\d+(?: \(\S+\))?) ====\s*(\w*)')
+
+P4DIFF2_FILE_REGEX = re.compile(r'^(.+?)#(\d+)(?: \((\S+)\))?$')
+
+# //depot/branch/... or //depot/branch/...@label
+P4BRANCH_REGEX = re.compile(r'^(//.*/)\.\.\.([@#].*)?$')
+
+
+class P4Error(Exception):
+    """
+        raised when p4 information can't be obtained or parsed
+    """
+    pass
+
+
+class FileDiff(object):
+    """
+        compact record describing the difference of one p4 file
+
+        depotfile  : depot path of the file (//depot/...)
+        clientfile : path of the file in the client workspace
+        rev        : revision the difference is taken against
+        fltype     : p4 file type (text, binary, ...); None only when p4
+                     doesn't report one
+        change     : 'edit', 'add' or 'delete'
+        hunks      : difference text starting at the first "@@" line, only
+                     produced when first accessed
+    """
+
+    __slots__ = ('depotfile', 'clientfile', 'rev', 'fltype', 'change',
+                 '_hunkfunc', '_hunks')
+
+    def __init__(self, depotfile, clientfile, rev, fltype, change, hunkfunc):
+        self.depotfile = depotfile
+        self.clientfile = clientfile
+        self.rev = rev
+        self.fltype = fltype
+        self.change = change
+        self._hunkfunc = hunkfunc
+        self._hunks = None
+
+    @property
+    def hunks(self):
+        """ difference text of the file, produced on first access """
+        if self._hunks is None:
+            self._hunks = self._hunkfunc()
+            self._hunkfunc = None
+        return self._hunks
+
+    def __repr__(self):
+        return "FileDiff(%r, %r, %r, %r, %r)" % (
+            self.depotfile, self.clientfile, self.rev, self.fltype,
+            self.change)
+
+    def __str__(self):
+        """ the record in the cr-codereview.py output format """
+        if self.change == 'edit':
+            header = MODIFIED_STR % (self.depotfile, self.clientfile,
+                                     self.rev, self.fltype)
+        elif self.change == 'add':
+            header = ADDED_STR % (self.depotfile, self.rev)
+        else:
+            header = DELETED_STR % (self.depotfile, self.rev)
+        return header + self.hunks
+
+
+def iswindows():
+    """ True when running on windows """
+    return sys.platform.startswith('win')
+
+
+def getp4depotinfo():
+    """
+        get the p4 depot information
+    """
+    output = ""
+    pipe = subprocess.Popen("p4 where", stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE, shell=True)
+    (output, err) = pipe.communicate()
+    if err or output == "":
+        pipe = subprocess.Popen("p4 client -o", stdout=subprocess.PIPE,
+                                shell=True)
+        (output, err) = pipe.communicate()
+        vals = str(output).split('\n')
+        #
+        # View:
+        # //depot/branch/pioneer-sivak-br1/... //sb14-pioneer-sivak-br1/...
+        try:
+            p4depot = vals[vals.index('View:') + 1]
+            p4depot = p4depot.strip()
+            vals = p4depot.split()
+            p4depot = None
+            for myval in vals[::-1]:
+                if myval.startswith('//depot'):
+                    p4depot = myval
+                    break
+
+        except (IndexError, ValueError):
+            raise P4Error("Couldn't get p4depot info")
+    else:
+
+        # The output looks like this:
+        # //depot/icm/proj/Appia/rev1.0/dev/newArchitecture/...  \
+        # //skumar+Appia+rev1.0+3/newArchitecture/... \
+        # /u/skumar/wa/HHead/newArchitecture/...
+        vals = str(output).split()
+
+        p4depot = None
+        # for myval in vals[::-1]:
+        #     if myval.startswith('//depot'):
+        #         p4depot = myval
+        #         break
+        myindstart = output.rfind("//depot")
+        if myindstart == -1:
+            raise P4Error("Couldn't get p4depot info from:\n%s\n" % (
+                output, ))
+        myindlast = output[myindstart:].find("...")
+        if myindlast != -1:
+            p4depot = output[myindstart:myindlast]
+
+    return (p4depot, output)
+
+
+def getp4info():
+    """ get p4 info details """
+
+    # sanity check, make sure that we're logged in ...
+    tpipe = subprocess.Popen(['p4', 'where'],
+                             stdout=subprocess.PIPE,
+                             stderr=subprocess.PIPE)
+    (toutput, terr) = tpipe.communicate()
+    if terr or toutput == "":
+        raise P4Error("Error, maybe not in workspace or not 'p4 logged in'?"
+                      "\n\nError message: %s\n" % (terr, ))
+
+    pipe = subprocess.Popen("p4 info", stdout=subprocess.PIPE, shell=True)
+    (output, err) = pipe.communicate()
+    if err or output == "":
+        raise P4Error("Error: %s, maybe not in p4 workspace?" % (err, ))
+    vals = str(output).split('\n')
+    myclroot = None
+    mycwd = None
+    for myval in vals:
+        if myval.startswith("Client root:"):
+            myclroot = myval[len("Client root:"):].strip()
+        elif myval.startswith("Current directory:"):
+            mycwd = myval[len("Current directory:"):].strip()
+        if myclroot and mycwd:
+            break
+
+    if not myclroot or not mycwd:
+        raise P4Error("Error: Unable to parse the output of 'p4 info':\n%s\n"
+                      % (output, ))
+
+    return (mycwd, myclroot)
+
+
+def get_modified_hunks(myopts, efile, revnum=""):
+    """ get the p4 diff hunks of a modified file """
+
+    mycmd = "p4 diff " + myopts + " " + "\"" + efile + "\"" + revnum
+    pipe = subprocess.Popen(mycmd,
+                            stdout=subprocess.PIPE, shell=True)
+
+    (output, _) = pipe.communicate()
+    lines = output.splitlines()
+
+    return '\n'.join(lines[2:]) + '\n'
+
+
+def get_add(afile):
+    """ get the hunk of an added file """
+
+    fdin = open(afile)
+    lines = fdin.read().replace('\xc2\x85', '\n').splitlines()
+    fdin.close()
+
+    output = '@@ -0,0 +1,' + str(len(lines)) + ' @@\n'
+    output += '+' + '\n+'.join(lines) + '\n'
+    return output
+
+
+def get_depot_lines(dfile, rev):
+    """ get the lines of a depot file at revision rev """
+
+    pipe = subprocess.Popen("p4 print -q " + "\"" + dfile + "\"" +
+                            '#' + rev, stdout=subprocess.PIPE,
+                            shell=True)
+
+    (output, _) = pipe.communicate()
+    return output.splitlines()
+
+
+def get_deleted(dfile, rev):
+
+    """ get the hunk of a deleted file """
+
+    lines = get_depot_lines(dfile, rev)
+
+    newoutput = '@@ -1,' + str(len(lines)) + ' +0,0 @@\n'
+
+    newoutput += '-' + '\n-'.join(lines) + '\n'
+    return newoutput
+
+
+def get_add_depot(dfile, rev):
+    """ get the hunk of a file added in the depot (range diffs) """
+
+    lines = get_depot_lines(dfile, rev)
+
+    newoutput = '@@ -0,0 +1,' + str(len(lines)) + ' @@\n'
+
+    newoutput += '+' + '\n+'.join(lines) + '\n'
+    return newoutput
+
+
+def get_clientfile(myclroot, depotfile, onwindows):
+    """ map a depot file to its path under the client root """
+
+    if onwindows:
+        return myclroot + depotfile[2:].replace('/', '\\')
+    # return depotfile.replace(p4depot, myclroot, 1)
+    return myclroot + depotfile[2:]
+
+
+def get_changed_files(p4depot, myclroot, filelist, onwindows=None):
+    """ get changed, new and deleted p4 files """
+
+    # p4depot = p4depot[0:p4depot.rindex("...")]
+
+    if onwindows is None:
+        onwindows = iswindows()
+
+    if len(filelist) == 0:
+        pipe = subprocess.Popen("p4 opened",
+                                stdout=subprocess.PIPE, shell=True)
+    else:
+        pipe = subprocess.Popen("p4 opened " + filelist,
+                                stdout=subprocess.PIPE, shell=True)
+
+    (output, _) = pipe.communicate()
+
+    existingfiles = []
+    newfiles = []
+    deletedfiles = []
+    # lines = str(output).split('\n')
+
+    # The output looks like this for each "p4 opened" file
+    # //depot/<SNIP>ev/newArchitecture/firmware/include/dbgMsgs.h#3 - \
+    #                                                 edit change
+    for line in str(output).split('\n'):
+        match = P4FILECHANGED_REGEX.search(line)
+        if match:
+            myf = get_clientfile(myclroot, match.group(1), onwindows)
+            revision = match.group(2)
+            changetype = match.group(3)
+            filetype = match.group(4)
+
+            if changetype == 'edit':
+                existingfiles.append((match.group(1), myf, revision, filetype))
+            elif changetype == 'add':
+                newfiles.append((match.group(1), myf, revision, filetype))
+            elif changetype == 'delete':
+                deletedfiles.append((match.group(1), myf, revision,
+                                     filetype))
+
+    return (existingfiles, newfiles, deletedfiles)
+
+
+def get_p4files(p4depot, myfiles, myclroot, onwindows=None):
+
+    """ get details of p4 opened  files """
+
+    fullfiles = []
+    for myfile in myfiles:
+        fullfiles.append("\"" + myfile + "\"")
+
+    filelist = " ".join(fullfiles)
+
+    return get_changed_files(p4depot, myclroot, filelist, onwindows)
+
+
+def iter_diffs(myopts=P4DEFAULT_OPT, myfiles=None, revnum=""):
+    """
+        yields a FileDiff for each opened file: modified files first, then
+        newly added files, then deleted files
+
+        myopts  : options passed to 'p4 diff' for modified files
+        myfiles : files (or "...") to restrict the diff to; all opened
+                  files when empty
+        revnum  : optional "@changelist" to diff modified files against
+
+        raises P4Error if not in a usable p4 workspace
+    """
+
+    onwindows = iswindows()
+
+    (_, myclroot) = getp4info()
+    myclroot += os.path.sep
+
+    (p4depot, output) = getp4depotinfo()
+
+    if not p4depot:
+        raise P4Error("Error in reading p4 depot info: %s couldn't be "
+                      "parsed\n" % (output,))
+
+    (existingfiles, newfiles, deletedfiles) = get_p4files(
+        p4depot, myfiles or [], myclroot, onwindows)
+
+    for (depotfile, efile, revision, fltype) in existingfiles:
+        yield FileDiff(depotfile, efile, revision, fltype, 'edit',
+                       lambda efile=efile: get_modified_hunks(
+                           myopts, efile, revnum))
+
+    for (dfile, nfile, revision, fltype) in newfiles:
+        yield FileDiff(dfile, nfile, revision, fltype, 'add',
+                       lambda nfile=nfile: get_add(nfile))
+
+    for (dfile, nfile, revision, fltype) in deletedfiles:
+        yield FileDiff(dfile, nfile, revision, fltype, 'delete',
+                       lambda dfile=dfile, revision=revision:
+                       get_deleted(dfile, revision))
+
+
+def get_revspec(p4path, revspec):
+    """
+        turn a revision spec into a "p4 diff2" file spec
+
+        //depot/branch/...   : p4path is taken relative to the branch
+                               root (branch comparisons), e.g. src/...
+                               gives //depot/branch/src/...
+        @label, @12345, #4   : appended to p4path
+        label, 12345         : appended to p4path as @label, @12345
+
+        raises P4Error for a depot path that isn't a //.../... branch
+        when p4path is given
+    """
+
+    if revspec.startswith('//'):
+        if p4path == "...":
+            return revspec
+        match = P4BRANCH_REGEX.match(revspec)
+        if not match:
+            raise P4Error("%s is not a branch path (//depot/branch/...), "
+                          "can't compare %s in it" % (revspec, p4path))
+        return match.group(1) + p4path + (match.group(2) or "")
+    if revspec.startswith('@') or revspec.startswith('#'):
+        return p4path + revspec
+    return p4path + '@' + revspec
+
+
+def parse_diff2_side(side):
+    """ split one side of a "p4 diff2" header into (file, rev, type) """
+
+    if side == '<none>':
+        return (None, None, None)
+    match = P4DIFF2_FILE_REGEX.match(side)
+    return (match.group(1), match.group(2), match.group(3))
+
+
+def join_hunks(hunklines):
+    """ join hunk lines into the hunks text, empty when there are none """
+
+    if not hunklines:
+        return ""
+    return '\n'.join(hunklines) + '\n'
+
+
+def get_diff2_records(lines):
+    """
+        split a "p4 diff2 -du" stream into
+        (leftside, rightside, status, hunks) tuples, one per file;
+        hunks is empty for files without differences in content
+    """
+
+    header = None
+    hunklines = []
+    for line in lines:
+        line = line.rstrip('\r\n')
+        match = P4DIFF2_HEADER_REGEX.match(line)
+        if match:
+            if header:
+                yield header + (join_hunks(hunklines), )
+            header = (parse_diff2_side(match.group(1)),
+                      parse_diff2_side(match.group(2)),
+                      match.group(3))
+            hunklines = []
+        elif header:
+            # drop any ---/+++ file lines ahead of the first hunk
+            if not hunklines and (line.startswith('--- ') or
+                                  line.startswith('+++ ')):
+                continue
+            hunklines.append(line)
+    if header:
+        yield header + (join_hunks(hunklines), )
+
+
+def iter_range_diffs(rev1, rev2, p4path="...", myopts=P4DEFAULT_OPT):
+    """
+        yields a FileDiff for each file that differs between two revision
+        specs (labels, changelists or branches) of p4path, using a single
+        "p4 diff2" stream; no files need to be opened
+
+        modified files are yielded as the stream is read, files only present
+        in rev2 ('add') or only in rev1 ('delete') follow in that order
+
+        all fields of a record come from the same side of the comparison:
+        rev1 for 'edit' and 'delete', rev2 for 'add'; clientfile is that
+        depot file mapped under the client root, which may not exist in
+        the workspace since no files are opened
+
+        raises P4Error if not in a usable p4 workspace or "p4 diff2" fails
+        or reports anything on stderr (e.g. an unknown label or path)
+    """
+
+    onwindows = iswindows()
+
+    (_, myclroot) = getp4info()
+    myclroot += os.path.sep
+
+    mycmd = "p4 diff2 " + myopts + " " + \
+            "\"" + get_revspec(p4path, rev1) + "\" " + \
+            "\"" + get_revspec(p4path, rev2) + "\""
+    # stderr goes to a file, so that p4 can't block on it while stdout
+    # is being read
+    errfile = tempfile.TemporaryFile()
+    pipe = subprocess.Popen(mycmd, stdout=subprocess.PIPE,
+                            stderr=errfile, shell=True)
+
+    newfiles = []
+    deletedfiles = []
+    try:
+        for ((lfile, lrev, ltype), (rfile, rrev, rtype), status, hunks) in \
+                get_diff2_records(iter(pipe.stdout.readline, '')):
+            if status in ('identical', 'types'):
+                # same content, at most the file type changed
+                continue
+            if lfile is None:
+                newfiles.append((rfile, rrev, rtype))
+            elif rfile is None:
+                deletedfiles.append((lfile, lrev, ltype))
+            elif hunks:
+                # binary files differ without any hunks, nothing to show
+                yield FileDiff(lfile,
+                               get_clientfile(myclroot, lfile, onwindows),
+                               lrev, ltype, 'edit', lambda hunks=hunks: hunks)
+
+        pipe.wait()
+        errfile.seek(0)
+        err = errfile.read()
+        if err or pipe.returncode != 0:
+            raise P4Error("Error running '%s': %s" % (mycmd, err))
+    finally:
+        # the caller may stop iterating before the stream is done
+        if pipe.poll() is None:
+            pipe.kill()
+            pipe.wait()
+        pipe.stdout.close()
+        errfile.close()
+
+    for (dfile, revision, fltype) in newfiles:
+        yield FileDiff(dfile, get_clientfile(myclroot, dfile, onwindows),
+                       revision, fltype, 'add',
+                       lambda dfile=dfile, revision=revision:
+                       get_add_depot(dfile, revision))
+
+    for (dfile, revision, fltype) in deletedfiles:
+        yield FileDiff(dfile, get_clientfile(myclroot, dfile, onwindows),
+                       revision, fltype, 'delete',
+                       lambda dfile=dfile, revision=revision:
+                       get_deleted(dfile, revision))